@@ -5,6 +5,7 @@ import argparse
 import json
 import os
 import psycopg
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import logging
 
@@ -12,58 +13,120 @@ import logging
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger()
 
+# Number of threads used to delete files from the uploads directory concurrently
+UNLINK_WORKERS = 32
 
-def find_referenced_files(main_conn):
+# Conditions selecting the rows that can contain references. They are shared by the optional partial indexes
+# and the queries using them, because Postgres only uses a partial index if the query implies its predicate.
+CHAT_REFERENCE_PREDICATE = (
+    "chat::jsonb @? '$.**.file_id' OR chat::jsonb @? '$.**.file.id' OR chat::jsonb @? '$.**.collection_name'"
+)
+FILE_COLLECTION_PREDICATE = "meta::jsonb @? '$.collection_name'"
+
+
+def create_indexes(main_conn, dry_run=False):
     """
-    Finds all referenced files in the chat and knowledge tables.
+    Creates partial indexes on the chats and files that can contain references and on non-archived chats for
+    finding old chats, if they do not exist yet.
+
+    The reference indexes only cover the rows matching CHAT_REFERENCE_PREDICATE and FILE_COLLECTION_PREDICATE,
+    which keeps them much smaller than GIN indexes over the whole JSON. The indexes are built concurrently
+    outside of the cleanup transaction, so that they persist independently of it and don't block writes by
+    Open WebUI.
 
     :param main_conn: Connection to the main database
-    :return: A set of referenced file IDs
+    :param dry_run: If True, skips index creation
+    """
+    queries = [
+        """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_reference_idx ON chat (id) WHERE
+        """ + CHAT_REFERENCE_PREDICATE,
+        """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS file_collection_idx ON file (id) WHERE
+        """ + FILE_COLLECTION_PREDICATE,
+        """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_unarchived_created_at_idx ON chat (created_at) WHERE NOT archived
+        """,
+    ]
+    if dry_run:
+        logger.info("Skipping index creation in dry-run mode")
+        return
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    main_conn.autocommit = True
+    try:
+        with main_conn.cursor() as cur:
+            for query in queries:
+                cur.execute(query)
+    finally:
+        main_conn.autocommit = False
+    logger.info(f"Created {len(queries)} indexes (if not existing)")
+
+def index_exists(conn, index_name):
     """
-    query_chat_1 = """
-        SELECT DISTINCT jsonb_path_query(chat::jsonb, '$.**.file_id') FROM chat
+    Checks whether an index exists.
+
+    :param conn: Connection to the database
+    :param index_name: Name of the index
+    :return: True if the index exists, False otherwise
     """
-    query_chat_2 = """
-        SELECT DISTINCT jsonb_path_query(chat::jsonb, '$.**.file.id') FROM chat
+    query = """
+        SELECT to_regclass(%s) IS NOT NULL
     """
-    query_knowledge = """
-        SELECT data FROM knowledge
+    with conn.cursor() as cur:
+        cur.execute(query, (index_name,))
+        return cur.fetchone()[0]
+
+def disable_synchronous_commit(conn):
     """
-    with main_conn.cursor() as cur:
-        # Extract from chats
-        cur.execute(query_chat_1)
-        files = set(row[0] for row in cur.fetchall())
-        cur.execute(query_chat_2)
-        files.update(set(row[0] for row in cur.fetchall()))
-        logger.info(f"Found {len(files)} referenced files in chats.")
-        # Extract from knowledge
-        cur.execute(query_knowledge)
-        for row in cur:
-            files.update(set(row[0].get('file_ids', [])))
-        logger.info(f"Found {len(files)} referenced files in chats and knowledge.")
-        logger.debug(f"Referenced files: {files}")
-        return files
-
-def find_unused_files_db(main_conn, referenced_files):
-    """
-    Identifies unused files in the main database by comparing all files with referenced files.
+    Disables waiting for the WAL to be flushed to disk on commit of the current transaction.
 
-    :param main_conn: Connection to the main database
-    :param referenced_files: Set of referenced file IDs
-    :return: A set of unused file IDs
+    If the database crashes right after the commit, the cleanup may be lost and has to be re-run,
+    but the database stays consistent.
+
+    :param conn: Connection to the database
     """
     query = """
-        SELECT id FROM file
+        SET LOCAL synchronous_commit = off
     """
-    with main_conn.cursor() as cur:
+    with conn.cursor() as cur:
         cur.execute(query)
-        all_files = set(row[0] for row in cur.fetchall())
-        logger.info(f"Found {len(all_files)} files in main DB.")
-        logger.debug(f"All files: {all_files}")
-        unused_files = all_files - referenced_files
-        logger.info(f"Found {len(unused_files)} unused files in main DB.")
-        logger.debug(f"Unused files: {unused_files}")
-        return unused_files
+
+def extract_chat_references(main_conn):
+    """
+    Extracts all file IDs and collection names referenced in chats into the temporary table chat_reference.
+
+    This way the chat table is scanned only once and the result is reused by the file and the collection cleanup.
+    The JSON of each chat is converted to jsonb once for all three paths. Only if the optional partial index
+    exists, the chats are restricted to those matching CHAT_REFERENCE_PREDICATE, which Postgres then takes from
+    the index instead of evaluating it again. The table is dropped at the end of the transaction.
+
+    :param main_conn: Connection to the main database
+    """
+    query_create = """
+        CREATE TEMP TABLE chat_reference ON COMMIT DROP AS
+        SELECT t.kind, t.v #>> '{}' AS ref FROM chat
+        CROSS JOIN LATERAL (SELECT chat::jsonb AS j OFFSET 0) c
+        CROSS JOIN LATERAL (
+            SELECT 'file', jsonb_path_query(c.j, '$.**.file_id')
+            UNION ALL
+            SELECT 'file', jsonb_path_query(c.j, '$.**.file.id')
+            UNION ALL
+            SELECT 'collection', jsonb_path_query(c.j, '$.**.collection_name')
+        ) t(kind, v)
+    """
+    # Without the partial index, the condition would only parse each chat's JSON again
+    if index_exists(main_conn, 'chat_reference_idx'):
+        query_create += """
+        WHERE
+        """ + CHAT_REFERENCE_PREDICATE
+    query_analyze = """
+        ANALYZE chat_reference
+    """
+    with main_conn.cursor() as cur:
+        cur.execute(query_create)
+        logger.info(f"Extracted {cur.rowcount} references from chats.")
+        cur.execute(query_analyze)
 
 def find_referenced_collections(main_conn):
     """
@@ -74,85 +137,99 @@ def find_referenced_collections(main_conn):
     :return: A set of referenced collection names
     """
     query_chat = """
-        SELECT DISTINCT jsonb_path_query(chat::jsonb, '$.**.collection_name') FROM chat
+        COPY (
+            SELECT ref FROM chat_reference WHERE kind = 'collection'
+        ) TO STDOUT (FORMAT BINARY)
     """
     query_files = """
-        SELECT DISTINCT jsonb_path_query(meta::jsonb, '$.collection_name') FROM file
+        SELECT jsonb_path_query(meta::jsonb, '$.collection_name') #>> '{}' FROM file
     """
+    # Without the partial index, the condition would only parse each file's meta again
+    if index_exists(main_conn, 'file_collection_idx'):
+        query_files += """
+        WHERE
+        """ + FILE_COLLECTION_PREDICATE
+    query_files = "COPY (" + query_files + ") TO STDOUT (FORMAT BINARY)"
     query_memory = """
-        SELECT DISTINCT user_id FROM memory
+        COPY (
+            SELECT user_id FROM memory
+        ) TO STDOUT (FORMAT BINARY)
     """
 
     with main_conn.cursor() as cur:
-        cur.execute(query_chat)
-        collections = set(row[0] for row in cur.fetchall())
+        with cur.copy(query_chat) as copy:
+            copy.set_types(['text'])
+            collections = {row[0] for row in copy.rows()}
         logger.info(f"Found {len(collections)} referenced collections in chats.")
-        cur.execute(query_files)
-        collections.update(set(row[0] for row in cur.fetchall()))
+        with cur.copy(query_files) as copy:
+            copy.set_types(['text'])
+            collections.update(row[0] for row in copy.rows())
         logger.info(f"Found {len(collections)} referenced collections in chats and files.")
-        cur.execute(query_memory)
-        collections.update(set(f"user-memory-{row[0]}" for row in cur.fetchall()))
-        logger.info(f"Found {len(collections)} referenced collections in chats, files and knowledge.")
-        logger.debug(f"Referenced Collections: {collections}")
-        return collections
-
-def find_unused_collections(vector_conn, referenced_collections):
+        with cur.copy(query_memory) as copy:
+            copy.set_types(['text'])
+            collections.update(f"user-memory-{row[0]}" for row in copy.rows())
+    logger.info(f"Found {len(collections)} referenced collections in chats, files and knowledge.")
+    logger.debug(f"Referenced Collections: {collections}")
+    return collections
+
+def get_referenced_filenames(main_conn, unused_files):
     """
-    Identifies unused collections in the vector database by comparing all collections with referenced collections.
+    Retrieves a set of filenames of all files in the file table that are not unused, stripping the directory
+    from the path column server-side.
 
-    :param vector_conn: Connection to the vector database
-    :param referenced_collections: Set of referenced collection names
-    :return: A set of unused collection names
-    """
-    query = """
-        SELECT DISTINCT collection_name FROM document_chunk
-    """
-    with vector_conn.cursor() as cur:
-        cur.execute(query)
-        all_collections = set(row[0] for row in cur.fetchall())
-        logger.info(f"Found {len(all_collections)} collections in vector DB.")
-        logger.debug(f"All Collections: {all_collections}")
-        unused_collections = all_collections - referenced_collections
-        logger.info(f"Found {len(unused_collections)} unused collections in vector DB.")
-        logger.debug(f"Unused Collections: {unused_collections}")
-        return unused_collections
-
-def get_filenames_by_ids(main_conn, file_ids):
-    """
-    Retrieves a set of filenames from the file table given a set of file IDs using the path column.
+    After the unused files have been deleted, all remaining files are referenced, so the unused files only
+    need to be excluded in debug mode.
 
     :param main_conn: Connection to the main database
-    :param file_ids: Set of file IDs
-    :return: A set of filenames
-    """
-    query = """
-        SELECT DISTINCT path FROM file WHERE id = ANY(%s)
+    :param unused_files: Set of unused file IDs still present in the file table (empty unless in debug mode)
+    :return: A frozenset of filenames
     """
-    if not file_ids:
-        return set()
-
+    if not unused_files:
+        query = """
+            SELECT regexp_replace(path, '^.*/', '') FROM file
+        """
+        params = None
+    else:
+        query = """
+            SELECT regexp_replace(path, '^.*/', '') FROM file
+            WHERE NOT EXISTS (
+                SELECT 1 FROM unnest(%s::text[]) AS unused(id)
+                WHERE unused.id = file.id
+            )
+        """
+        params = [list(unused_files)]
     with main_conn.cursor() as cur:
-        cur.execute(query, [list(file_ids)])
-        filenames = set(os.path.basename(row[0]) for row in cur.fetchall())
-        logger.info(f"Retrieved {len(filenames)} filenames for the given file IDs.")
+        cur.execute(query, params)
+        filenames = frozenset(row[0] for row in cur)
+        logger.info(f"Retrieved {len(filenames)} filenames of referenced files.")
         logger.debug(f"Filenames: {filenames}")
         return filenames
 
-def find_unused_filenames_fs(referenced_filenames, uploads_dir):
+def list_filenames_fs(uploads_dir):
     """
-    Identifies unused files on the filesystem by comparing files in the database with files in the uploads directory.
+    Lists all files in the uploads directory.
 
-    :param referenced_filenames: Set of filenames present in the file table
     :param uploads_dir: Path to the uploads directory
-    :return: A set of filenames to be deleted from the filesystem
+    :return: A set of filenames in the uploads directory
     """
     try:
-        filenames = set(os.listdir(uploads_dir))
+        with os.scandir(uploads_dir) as entries:
+            filenames = {entry.name for entry in entries}
         logger.info(f"Found {len(filenames)} files in uploads directory.")
         logger.debug(f"Files in uploads directory: {filenames}")
+        return filenames
     except Exception as e:
         logger.error(f"Error listing files in uploads directory: {str(e)}")
         raise
+
+def find_unused_filenames_fs(referenced_filenames, filenames):
+    """
+    Identifies unused files on the filesystem by comparing files in the database with files in the uploads directory.
+
+    :param referenced_filenames: Set of filenames present in the file table
+    :param filenames: Set of filenames in the uploads directory
+    :return: A set of filenames to be deleted from the filesystem
+    """
     unused_filenames = filenames - referenced_filenames
     logger.info(f"Found {len(unused_filenames)} unused files in uploads directory.")
     logger.debug(f"Unused files in uploads directory: {unused_filenames}")
@@ -183,54 +260,110 @@ def cleanup_chats(main_conn, days, debug=False):
             logger.debug(cur.fetchall())
         logger.info(f"Deleted {cur.rowcount} chats")
 
-def cleanup_files_db(main_conn, unused_files, debug=False):
+def cleanup_files_db(main_conn, debug=False):
     """
-    Deletes unused files from the files table in the main database.
+    Deletes files that are not referenced in the chat (see extract_chat_references) or knowledge tables from the
+    files table in the main database.
+
+    Finding the referenced files and deleting the unused ones is done in a single statement.
 
     :param main_conn: Connection to the main database
-    :param unused_files: Set of unused file IDs
     :param debug: If True, executes SELECT instead of DELETE and prints results
+    :return: A frozenset of unused file IDs that are still present in the file table (i.e. empty unless in debug mode)
+    """
+    query_referenced = """
+        WITH referenced AS (
+            SELECT ref AS id FROM chat_reference WHERE kind = 'file'
+            UNION ALL
+            SELECT jsonb_path_query(data::jsonb, '$.file_ids[*]') #>> '{}' FROM knowledge
+        )
     """
     if not debug:
-        query = """
+        query = query_referenced + """
             DELETE FROM file
-            WHERE id = ANY(%s)
+            WHERE NOT EXISTS (SELECT 1 FROM referenced WHERE referenced.id = file.id)
         """
     else:
-        query = """
+        query = query_referenced + """
             SELECT id FROM file
-            WHERE id = ANY(%s)
+            WHERE NOT EXISTS (SELECT 1 FROM referenced WHERE referenced.id = file.id)
         """
     with main_conn.cursor() as cur:
-        cur.execute(query, [list(unused_files)])
+        cur.execute(query)
         if debug:
-            logger.debug(cur.fetchall())
+            unused_files = frozenset(row[0] for row in cur)
+            logger.debug(unused_files)
+        else:
+            unused_files = frozenset()
         logger.info(f"Deleted {cur.rowcount} files from DB")
+        return unused_files
 
-def cleanup_collections(vector_conn, unused_collections, debug=False):
+def cleanup_collections(vector_conn, referenced_collections, debug=False):
     """
-    Deletes unused collections from the vector database.
+    Deletes collections that are not referenced anymore from the vector database.
+
+    The referenced collections live in the main database, so they are streamed via COPY into the temporary
+    table referenced_collection (dropped at the end of the transaction) instead of being sent as one huge
+    array parameter. The unused collections are then deleted via an anti-join in a single statement.
 
     :param vector_conn: Connection to the vector database
-    :param unused_collections: Set of unused collection names
+    :param referenced_collections: Set of referenced collection names
     :param debug: If True, executes SELECT instead of DELETE and prints results
     """
+    query_create = """
+        CREATE TEMP TABLE referenced_collection (collection_name text) ON COMMIT DROP
+    """
+    query_copy = """
+        COPY referenced_collection FROM STDIN (FORMAT BINARY)
+    """
+    query_analyze = """
+        ANALYZE referenced_collection
+    """
     if not debug:
         query = """
             DELETE FROM document_chunk
-            WHERE collection_name = ANY(%s)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM referenced_collection AS referenced
+                WHERE referenced.collection_name = document_chunk.collection_name
+            )
         """
     else:
         query = """
             SELECT collection_name FROM document_chunk
-            WHERE collection_name = ANY(%s)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM referenced_collection AS referenced
+                WHERE referenced.collection_name = document_chunk.collection_name
+            )
         """
+    # Starts the vector DB transaction only now, so it doesn't sit idle during the main DB steps
+    disable_synchronous_commit(vector_conn)
     with vector_conn.cursor() as cur:
-        cur.execute(query, [list(unused_collections)])
+        cur.execute(query_create)
+        with cur.copy(query_copy) as copy:
+            copy.set_types(['text'])
+            for collection_name in referenced_collections:
+                copy.write_row((collection_name,))
+        cur.execute(query_analyze)
+        cur.execute(query)
         if debug:
             logger.debug(cur.fetchall())
         logger.info(f"Deleted {cur.rowcount} collections")
 
+def _safe_unlink(file_path):
+    """
+    Deletes a single file, logging instead of raising on failure.
+
+    :param file_path: Path of the file to be deleted
+    :return: True if the file was deleted, False otherwise
+    """
+    try:
+        os.remove(file_path)
+        logger.debug(f"Deleted file: {file_path}")
+        return True
+    except Exception as e:
+        logger.error(f"Error deleting file {file_path}: {str(e)}")
+        return False
+
 def cleanup_files_fs(unused_filenames, uploads_dir, dry_run=False):
     """
     Deletes unused files from the uploads directory.
@@ -239,17 +372,13 @@ def cleanup_files_fs(unused_filenames, uploads_dir, dry_run=False):
     :param uploads_dir: Path to the uploads directory
     :param dry_run: If True, performs a dry run without deleting any files
     """
-    num_deleted_files = 0
-    for filename in unused_filenames:
-        file_path = os.path.join(uploads_dir, filename)
-        if not dry_run:
-            try:
-                os.remove(file_path)
-                logger.debug(f"Deleted file: {file_path}")
-                num_deleted_files += 1
-            except Exception as e:
-                logger.error(f"Error deleting file {file_path}: {str(e)}")
-        else:
+    file_paths = (os.path.join(uploads_dir, filename) for filename in unused_filenames)
+    if not dry_run:
+        with ThreadPoolExecutor(max_workers=UNLINK_WORKERS) as executor:
+            num_deleted_files = sum(executor.map(_safe_unlink, file_paths))
+    else:
+        num_deleted_files = 0
+        for file_path in file_paths:
             logger.debug(f"Deleted file: {file_path}")
             num_deleted_files += 1
     logger.info(f"Deleted {num_deleted_files} files from filesystem")
@@ -260,7 +389,13 @@ def main():
 
     Parses command line arguments, establishes database connections, and performs cleanup operations.
     """
-    parser = argparse.ArgumentParser(description='Open WebUI Cleanup Script')
+    parser = argparse.ArgumentParser(
+        description='Open WebUI Cleanup Script',
+        epilog='All cleanup changes to a database are made in a single transaction that is committed with '
+               'synchronous_commit disabled: if the database crashes right after the script finished, '
+               'the cleanup may be lost and has to be re-run, but the database stays consistent. '
+               'Indexes created by --create-indexes are committed separately beforehand.'
+    )
     parser.add_argument('--main-db-url', required=True)
     parser.add_argument('--vector-db-url', required=True)
     parser.add_argument('--uploads-dir', required=True)
@@ -268,6 +403,7 @@ def main():
     parser.add_argument('--dry-run', action='store_true', default=False)
     parser.add_argument('--verbose', action='store_true', default=False)
     parser.add_argument('--debug', action='store_true', default=False)
+    parser.add_argument('--create-indexes', action='store_true', default=False)
     args = parser.parse_args()
 
     if args.verbose:
@@ -280,23 +416,38 @@ def main():
     vector_conn = psycopg.connect(args.vector_db_url)
 
     try:
-        # Step 1: Cleanup old chats
-        cleanup_chats(main_conn, args.keep_days, args.debug)
-
-        # Step 2: Delete unused files from DB
-        referenced_files = find_referenced_files(main_conn)
-        unused_files = find_unused_files_db(main_conn, referenced_files)
-        cleanup_files_db(main_conn, unused_files, args.debug)
-
-        # Step 3: Delete unused collections from vector DB
-        referenced_collections = find_referenced_collections(main_conn)
-        unused_collections = find_unused_collections(vector_conn, referenced_collections)
-        cleanup_collections(vector_conn, unused_collections, args.debug)
-
-        # Step 4: Delete unused files from filesystem
-        referenced_filenames = get_filenames_by_ids(main_conn, referenced_files)
-        unused_filenames_fs = find_unused_filenames_fs(referenced_filenames, args.uploads_dir)
-        cleanup_files_fs(unused_filenames_fs, args.uploads_dir, args.dry_run)
+        # The main database steps depend on each other's uncommitted deletions and thus share one connection,
+        # but listing the uploads directory and, once the referenced collections are known, the vector database
+        # cleanup are independent and run alongside the read-only part of step 4
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            filenames_future = executor.submit(list_filenames_fs, args.uploads_dir)
+
+            # Step 0: Optionally create indexes accelerating the reference queries
+            if args.create_indexes:
+                create_indexes(main_conn, args.dry_run)
+
+            disable_synchronous_commit(main_conn)
+
+            # Step 1: Cleanup old chats
+            cleanup_chats(main_conn, args.keep_days, args.debug)
+
+            # Step 2: Delete unused files from DB
+            extract_chat_references(main_conn)
+            unused_files = cleanup_files_db(main_conn, args.debug)
+
+            # Step 3: Delete unused collections from vector DB
+            referenced_collections = find_referenced_collections(main_conn)
+            collections_future = executor.submit(
+                cleanup_collections, vector_conn, referenced_collections, args.debug
+            )
+
+            # Step 4: Delete unused files from filesystem
+            referenced_filenames = get_referenced_filenames(main_conn, unused_files)
+            unused_filenames_fs = find_unused_filenames_fs(referenced_filenames, filenames_future.result())
+
+            # Files are only deleted after all database steps have succeeded
+            collections_future.result()
+            cleanup_files_fs(unused_filenames_fs, args.uploads_dir, args.dry_run)
 
         if not args.dry_run:
             main_conn.commit()